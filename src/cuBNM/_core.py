@@ -1,22 +1,137 @@
 """
-This imports run_simulations extension while
+This lazily imports the run_simulations extension while
 handling some known issues that may occur during import
 in addition to initializing the extension
+
+The compiled extension is only loaded and initialized on the
+first call to one of the functions below, so that importing
+cuBNM does not require loading the CUDA-linked library
+
+The constants and configs set via these functions are tracked
+on the python side to skip redundant calls and cache get_conf.
+Therefore the functions of the cuBNM.core extension should not
+be called directly, as this leaves the tracked values stale;
+if they have been called, use init() to reset them
 """
-try:
-    from cuBNM.core import run_simulations
-except ImportError as e:
-    error_msg = str(e)
-    if "GLIBC_2.29" in error_msg:
-        print(error_msg)
-        print("To fix this error either update `ldd` or build cuBNM from source (https://github.com/amnsbr/cuBNM)")
-        exit(1)
-    elif "undefined symbol" in error_msg:
-        print(error_msg)
-        print("To fix this error try building cuBNM from source (https://github.com/amnsbr/cuBNM)")
-        exit(1)
-    else:
+import threading
+
+_ext = None
+_initialized = False
+_init_lock = threading.Lock()
+# python-side copy of the session configs, which is
+# reset whenever the configs are changed
+_conf_cache = None
+# last values set via set_const and set_conf, used to skip
+# calls that would not change the constants/configs (these
+# do not reflect calls made directly to cuBNM.core)
+_last_consts = {}
+_last_confs = {}
+# known import errors of the extension and how to fix them
+_import_error_hints = (
+    (
+        "GLIBC_2.29",
+        "To fix this error either update `ldd` or build cuBNM from source (https://github.com/amnsbr/cuBNM)",
+    ),
+    (
+        "undefined symbol",
+        "To fix this error try building cuBNM from source (https://github.com/amnsbr/cuBNM)",
+    ),
+)
+
+
+def _load_core():
+    """
+    Imports the compiled extension
+    """
+    try:
+        from cuBNM import core
+    except ImportError as e:
+        error_msg = str(e)
+        for needle, hint in _import_error_hints:
+            if needle in error_msg:
+                print(error_msg)
+                print(hint)
+                exit(1)
         raise(e)
-else:
-    from cuBNM.core import init, set_const, set_conf, get_conf
-    init()
\ No newline at end of file
+    return core
+
+
+def _ensure_init():
+    """
+    Loads and initializes the extension once per session
+
+    Returns
+    -------
+    ext: (module)
+        the initialized cuBNM.core extension
+    """
+    global _ext, _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                _ext = _load_core()
+                _ext.init()
+                _initialized = True
+    return _ext
+
+
+def init():
+    """
+    (Re-)initializes the session configs and constants
+    to their default values. See cuBNM.core.init
+    """
+    global _conf_cache
+    _conf_cache = None
+    _last_consts.clear()
+    _last_confs.clear()
+    if _initialized:
+        _ext.init()
+    else:
+        _ensure_init()
+
+
+def run_simulations(*args):
+    """
+    Runs a group of simulations. See cuBNM.core.run_simulations
+    """
+    return _ensure_init().run_simulations(*args)
+
+
+def set_const(key, value):
+    """
+    Sets the value of a model constant. See cuBNM.core.set_const
+    The call is skipped if the constant already has this value,
+    as setting it forces reinitialization of the next simulations
+    """
+    if (key in _last_consts) and (_last_consts[key] == value):
+        return
+    out = _ensure_init().set_const(key, value)
+    _last_consts[key] = value
+    return out
+
+
+def set_conf(key, value):
+    """
+    Sets the session configs. See cuBNM.core.set_conf
+    The call is skipped if the config already has this value,
+    as setting it forces reinitialization of the next simulations
+    """
+    global _conf_cache
+    if (key in _last_confs) and (_last_confs[key] == value):
+        return
+    out = _ensure_init().set_conf(key, value)
+    _last_confs[key] = value
+    _conf_cache = None
+    return out
+
+
+def get_conf():
+    """
+    Gets the session configs. See cuBNM.core.get_conf
+    """
+    global _conf_cache
+    if _conf_cache is None:
+        _conf_cache = _ensure_init().get_conf()
+    # return a copy so that the cache is not
+    # modified by the caller
+    return dict(_conf_cache)
@@ -1,15 +1,193 @@
 import numpy as np
-import scipy.stats
 import pandas as pd
 import os
 import gc
+import functools
+import hashlib
+import tempfile
+import zipfile
 
-from cuBNM._core import run_simulations, set_const, set_conf
+from cuBNM import _core
 from cuBNM._setup_flags import many_nodes_flag, gpu_enabled_flag
 from cuBNM import utils
 
+# maximum size of simulation outputs (in bytes) which
+# will be compressed when saved as npz
+MAX_COMPRESSED_SAVE_SIZE = 1024**3
+# maximum number of binary copies of the loaded matrices which are
+# kept in the cache directory (see _get_matrix_cache_dir)
+MAX_CACHED_MATRICES = 64
+
+
+def _get_matrix_cache_dir():
+    """
+    Gets the directory in which binary copies of the loaded
+    matrices are stored, which is "matrices" within
+    $CUBNM_CACHE_DIR if it is set, or otherwise within
+    $XDG_CACHE_HOME/cuBNM or ~/.cache/cuBNM. Setting
+    CUBNM_CACHE_DIR to an empty string disables the copies
+
+    Returns
+    -------
+    cache_dir: (str or None)
+        None if the copies are disabled or there is
+        no home directory
+    """
+    cache_dir = os.environ.get("CUBNM_CACHE_DIR")
+    if cache_dir is None:
+        if os.environ.get("XDG_CACHE_HOME"):
+            cache_dir = os.path.join(os.environ["XDG_CACHE_HOME"], "cuBNM")
+        else:
+            home = os.path.expanduser("~")
+            if home == "~":
+                # expanduser returns "~" as is when HOME is not set
+                # and the user has no home directory
+                return None
+            cache_dir = os.path.join(home, ".cache", "cuBNM")
+    elif not cache_dir:
+        return None
+    return os.path.join(cache_dir, "matrices")
+
+
+def _prune_matrix_cache(cache_dir):
+    """
+    Removes the least recently used binary copies
+    in `cache_dir` beyond MAX_CACHED_MATRICES
+
+    Parameters
+    ---------
+    cache_dir: (str)
+    """
+    copies = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npz"):
+            copies.append((entry.stat().st_mtime, entry.path))
+    copies.sort()
+    for _, path in copies[: max(len(copies) - MAX_CACHED_MATRICES, 0)]:
+        os.remove(path)
+
+
+def _load_matrix(path):
+    """
+    Loads a matrix from a text file. A binary copy of the
+    matrix is saved in the cache directory (see
+    _get_matrix_cache_dir) together with the size and
+    modification time of the text file, and is used in the
+    next calls only if both still match. The loaded matrices
+    are cached and returned as read-only arrays
+
+    Parameters
+    ---------
+    path: (str)
+        path to the text file
+
+    Returns
+    -------
+    mat: (np.ndarray)
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return _load_matrix_cached(path, stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_matrix_cached(path, mtime_ns, size):
+    """
+    Loads a matrix from a text file or its binary copy.
+    See _load_matrix
+
+    Parameters
+    ---------
+    path: (str)
+        absolute path to the text file
+    mtime_ns: (int)
+        modification time of the text file in nanoseconds
+    size: (int)
+        size of the text file in bytes
+
+    Returns
+    -------
+    mat: (np.ndarray)
+    """
+    cache_dir = _get_matrix_cache_dir()
+    if cache_dir is None:
+        mat = np.loadtxt(path)
+        mat.setflags(write=False)
+        return mat
+    npz_path = os.path.join(
+        cache_dir, hashlib.sha1(path.encode()).hexdigest() + ".npz"
+    )
+    mat = None
+    try:
+        with np.load(npz_path) as copy:
+            # the mtime of the text file must match exactly (rather than
+            # being older than the copy) as it can be set to an older time
+            # when the file is replaced, e.g. by cp -p or rsync -a
+            if (copy["mtime_ns"] == mtime_ns) and (copy["size"] == size):
+                mat = copy["mat"]
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        # missing, corrupt or truncated copy, which will be overwritten
+        pass
+    if mat is not None:
+        try:
+            # mark the copy as recently used
+            os.utime(npz_path)
+        except OSError:
+            pass
+    else:
+        mat = np.loadtxt(path)
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a temporary file and then move it in place so that
+            # other processes never see a partially written copy
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, mat=mat, mtime_ns=mtime_ns, size=size)
+            os.replace(tmp_path, npz_path)
+            _prune_matrix_cache(cache_dir)
+        except OSError:
+            # e.g. when the directory is read-only
+            if (tmp_path is not None) and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    mat.setflags(write=False)
+    return mat
+
+
+def _reshape_view(arr, shape):
+    """
+    Reshapes an array without copying its data. Unlike
+    .reshape this raises an error (instead of silently copying
+    the array) if the array cannot be reshaped in place
+
+    Parameters
+    ---------
+    arr: (np.ndarray)
+    shape: (tuple)
+
+    Returns
+    -------
+    view: (np.ndarray)
+        view of `arr` with the new shape
+    """
+    view = arr.view()
+    view.shape = shape
+    return view
+
 
 class SimGroup:
+    # attributes holding the simulation outputs, which are removed by .clear
+    _output_attrs = (
+        "sim_bold",
+        "sim_fc_trils",
+        "_sim_fcd_trils",
+        "_sim_fcd_trils_sorted",
+        "ext_out",
+        "fic_unstable",
+    )
+    # parameters in param_lists which are not regional
+    _global_params = ("G", "v")
+
     def __init__(
         self,
         duration,
@@ -39,10 +217,15 @@ class SimGroup:
             BOLD TR and sampling rate of extended output (in seconds)
         sc_path: (str)
             path to structural connectome strengths (as an unlabled .txt)
+            A binary copy of the SC is stored in $CUBNM_CACHE_DIR/matrices
+            (default: $XDG_CACHE_HOME/cuBNM/matrices or
+            ~/.cache/cuBNM/matrices) to speed up loading it next
+            time. Set CUBNM_CACHE_DIR to an empty string to disable this
         sc_dist_path: (str)
             path to structural connectome distances
             if provided v (velocity) will be a free parameter and there
             will be delay in inter-regional connections
+            (a binary copy of it is stored similar to sc_path)
         out_dir: (str)
             if 'same' will create a directory named based on sc_path
         do_fic: (bool)
@@ -77,7 +260,7 @@ class SimGroup:
         self.sc_path = sc_path
         self.sc_dist_path = sc_dist_path
         self._out_dir = out_dir
-        self.sc = np.loadtxt(self.sc_path)
+        self.sc = _load_matrix(self.sc_path)
         self.do_fic = do_fic
         self.extended_output = (
             extended_output | do_fic
@@ -113,7 +296,7 @@ class SimGroup:
         # inter-regional delay will be added to the simulations
         # if SC distance matrix is provided
         if self.sc_dist_path:
-            self.sc_dist = np.loadtxt(self.sc_dist_path)
+            self.sc_dist = _load_matrix(self.sc_dist_path)
             self.do_delay = True
         else:
             self.sc_dist = np.zeros_like(self.sc, dtype=float)
@@ -149,6 +332,36 @@ class SimGroup:
         if not self.do_delay:
             self.param_lists["v"] = np.zeros(self._N, dtype=float)
 
+    @property
+    def sc(self):
+        return self._sc
+
+    @sc.setter
+    def sc(self, sc):
+        self._sc = sc
+        # flattened SC which is passed on to run_simulations
+        # is created once as it does not change across runs
+        self._sc_flat = np.ascontiguousarray(self._sc, dtype=float).ravel()
+
+    @property
+    def sc_dist(self):
+        return self._sc_dist
+
+    @sc_dist.setter
+    def sc_dist(self, sc_dist):
+        self._sc_dist = sc_dist
+        self._sc_dist_flat = np.ascontiguousarray(self._sc_dist, dtype=float).ravel()
+
+    @property
+    def sim_fcd_trils(self):
+        return self._sim_fcd_trils
+
+    @sim_fcd_trils.setter
+    def sim_fcd_trils(self, sim_fcd_trils):
+        self._sim_fcd_trils = sim_fcd_trils
+        # sorted copy cached by .score is no longer valid
+        self._sim_fcd_trils_sorted = None
+
     @property
     def bw_params(self):
         return self._bw_params
@@ -157,9 +370,9 @@ class SimGroup:
     def bw_params(self, bw_params):
         self._bw_params = bw_params
         params = utils.get_bw_params(self._bw_params)
-        set_const("k1", params["k1"])
-        set_const("k2", params["k2"])
-        set_const("k3", params["k3"])
+        _core.set_const("k1", params["k1"])
+        _core.set_const("k2", params["k2"])
+        _core.set_const("k3", params["k3"])
 
     @property
     def exc_interhemispheric(self):
@@ -168,7 +381,7 @@ class SimGroup:
     @exc_interhemispheric.setter
     def exc_interhemispheric(self, exc_interhemispheric):
         self._exc_interhemispheric = exc_interhemispheric
-        set_conf("exc_interhemispheric", self._exc_interhemispheric)
+        _core.set_conf("exc_interhemispheric", self._exc_interhemispheric)
 
     @property
     def do_delay(self):
@@ -192,7 +405,7 @@ class SimGroup:
     @sync_msec.setter
     def sync_msec(self, sync_msec):
         self._sync_msec = sync_msec
-        set_conf("sync_msec", self._sync_msec)
+        _core.set_conf("sync_msec", self._sync_msec)
 
     def get_config(self, include_N=False):
         config = {
@@ -215,11 +428,32 @@ class SimGroup:
             config["N"] = self.N
         return config
 
+    def _check_params(self):
+        """
+        Checks if all parameters are set and have the expected sizes,
+        as run_simulations does not check them and would read out of
+        bounds or crash otherwise
+        """
+        for param, values in self.param_lists.items():
+            if values is None:
+                raise ValueError(f"{param} is not set")
+            # global parameters have one value per simulation and
+            # regional parameters have one value per node and simulation
+            if param in self._global_params:
+                size = self.N
+            else:
+                size = self.N * self.nodes
+            if np.size(values) != size:
+                raise ValueError(
+                    f"{param} has {np.size(values)} values "
+                    f"but {size} values are expected with N={self.N} and nodes={self.nodes}"
+                )
+
     def run(self, force_reinit=False):
         """
         Run the simulations in parallel on GPU
         """
-        # TODO: add assertions to make sure all the data is complete
+        self._check_params()
         force_reinit = (
             force_reinit
             | (self.N != self.last_N)
@@ -232,20 +466,20 @@ class SimGroup:
         # of do_fic it is overwritten with the actual wIE
         # used in the simulations
         # Note that the 2D arrays are flattened to a 1D (pseudo-2D) array
-        # and all arrays are made C-contiguous using .ascontiguousarray
-        # .ascontiguousarray may be redundant with .flatten but I'm doing
-        # it to be sure
+        # and all arrays are made C-contiguous float arrays using
+        # .ascontiguousarray, which (together with .ravel) does not copy
+        # the arrays that are already C-contiguous and of type float
         self.param_lists["wIE"] = np.ascontiguousarray(
-            self.param_lists["wIE"].flatten()
-        )
-        out = run_simulations(
-            np.ascontiguousarray(self.sc.flatten()),
-            np.ascontiguousarray(self.sc_dist.flatten()),
-            np.ascontiguousarray(self.param_lists["G"]),
-            np.ascontiguousarray(self.param_lists["wEE"].flatten()),
-            np.ascontiguousarray(self.param_lists["wEI"].flatten()),
+            self.param_lists["wIE"], dtype=float
+        ).flatten()
+        out = _core.run_simulations(
+            self._sc_flat,
+            self._sc_dist_flat,
+            np.ascontiguousarray(self.param_lists["G"], dtype=float),
+            np.ascontiguousarray(self.param_lists["wEE"], dtype=float).ravel(),
+            np.ascontiguousarray(self.param_lists["wEI"], dtype=float).ravel(),
             self.param_lists["wIE"],
-            np.ascontiguousarray(self.param_lists["v"]),
+            np.ascontiguousarray(self.param_lists["v"], dtype=float),
             self.do_fic,
             self.extended_output,
             self.do_delay,
@@ -265,8 +499,20 @@ class SimGroup:
         self.last_nodes = self.nodes
         self.last_duration = self.duration
         self.it += 1
-        # assign the output to object properties
-        # and reshape them to (N_SIMS, ...)
+        self._process_out(out)
+
+    def _process_out(self, out):
+        """
+        Assigns the output of run_simulations to object properties
+        and reshapes them to (N_SIMS, ...) without copying them, except
+        for sim_bold which is copied as float32 (while converting it
+        both float64 and float32 copies of BOLD are held in memory)
+
+        Parameters
+        ---------
+        out: (tuple)
+            output of run_simulations
+        """
         ext_out = {}
         if self.extended_output:
             (
@@ -284,26 +530,38 @@ class SimGroup:
                 ext_out["I_ratio"],
                 self.fic_unstable,
             ) = out
-            self.ext_out = ext_out
-            for k in self.ext_out:
-                self.ext_out[k] = self.ext_out[k].reshape(self.N, -1)
+            self.ext_out = {
+                k: _reshape_view(v, (self.N, -1)) for k, v in ext_out.items()
+            }
         else:
             sim_bold, sim_fc_trils, sim_fcd_trils, self.fic_unstable = out
-        self.sim_bold = sim_bold.reshape(self.N, -1, self.nodes)
-        self.sim_fc_trils = sim_fc_trils.reshape(self.N, -1)
-        self.sim_fcd_trils = sim_fcd_trils.reshape(self.N, -1)
-        self.param_lists["wIE"] = self.param_lists["wIE"].reshape(self.N, -1)
+        # BOLD is stored in single precision as it is the largest
+        # output and does not need double precision after the
+        # simulations (FC and FCD are calculated by run_simulations)
+        self.sim_bold = _reshape_view(
+            sim_bold.astype(np.float32), (self.N, -1, self.nodes)
+        )
+        self.sim_fc_trils = _reshape_view(sim_fc_trils, (self.N, -1))
+        self.sim_fcd_trils = _reshape_view(sim_fcd_trils, (self.N, -1))
+        self.param_lists["wIE"] = _reshape_view(self.param_lists["wIE"], (self.N, -1))
 
-    def clear(self):
+    def clear(self, collect=False):
         """
         Clear the simulation outputs
+
+        Parameters
+        ---------
+        collect: (bool)
+            run garbage collection after clearing the outputs. This is
+            usually not needed as the output arrays are freed as soon
+            as they are no longer referenced
         """
-        for attr in ["sim_bold", "sim_fc_trils", "sim_fcd_trils", "ext_out", "fic_unstable"]:
-            if hasattr(self, attr):
-                delattr(self, attr)
-        gc.collect()
+        for attr in self._output_attrs:
+            self.__dict__.pop(attr, None)
+        if collect:
+            gc.collect()
 
-    def score(self, emp_fc_tril, emp_fcd_tril, fic_penalty_scale=2):
+    def score(self, emp_fc_tril, emp_fcd_tril, fic_penalty_scale=2, cache_sorted=False):
         """
         Calcualates gof term and aggregates them as indicated.
         In FIC models also calculates fic_penalty. To ignore fic_penalty
@@ -316,48 +574,105 @@ class SimGroup:
         emp_fcd_tril: (np.array)
             1D array of empirical FCD lower triangle
         fic_penalty_scale: (float)
+        cache_sorted: (bool)
+            keep a sorted copy of sim FCDs, which speeds up the next
+            calls (e.g. with different empirical data) but doubles
+            the memory used by sim FCDs until .clear is called. The
+            copy is dropped when sim_fcd_trils is reassigned, but not
+            when it is modified in place
         """
         # + => aim to maximize; - => aim to minimize
         # TODO: add the option to provide empirical BOLD as input
         columns = ["+fc_corr", "-fc_diff", "-fcd_ks", "-fc_normec", "+gof"]
         if self.do_fic:
             columns.append("-fic_penalty")
-        scores = pd.DataFrame(columns=columns, dtype=float)
-        # calculate GOF
-        for idx in range(self.N):
-            scores.loc[idx, "+fc_corr"] = scipy.stats.pearsonr(
-                self.sim_fc_trils[idx], emp_fc_tril
-            ).statistic
-            scores.loc[idx, "-fc_diff"] = -np.abs(
-                self.sim_fc_trils[idx].mean() - emp_fc_tril.mean()
+        col_idx = {col: i for i, col in enumerate(columns)}
+        # scores are written into a single preallocated array
+        # which is converted to a DataFrame at the end
+        scores = np.full((self.N, len(columns)), np.nan, dtype=np.float64)
+        # calculate GOF (vectorized across simulations)
+        # FC correlation and difference are derived from sums, sums of
+        # squares and dot products with the empirical FC, which are
+        # calculated for all simulations with BLAS-backed reductions
+        n_pairs = emp_fc_tril.size
+        sim_fc_sum = self.sim_fc_trils.sum(axis=1)
+        sim_fc_sqsum = np.einsum("ij,ij->i", self.sim_fc_trils, self.sim_fc_trils)
+        sim_emp_dot = self.sim_fc_trils @ emp_fc_tril
+        emp_fc_sum = emp_fc_tril.sum()
+        emp_fc_sqsum = emp_fc_tril @ emp_fc_tril
+        # Pearson correlation
+        fc_cov = sim_emp_dot - sim_fc_sum * emp_fc_sum / n_pairs
+        sim_fc_ss = sim_fc_sqsum - sim_fc_sum**2 / n_pairs
+        emp_fc_ss = emp_fc_sqsum - emp_fc_sum**2 / n_pairs
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fc_corr = fc_cov / np.sqrt(sim_fc_ss * emp_fc_ss)
+        # the correlation is undefined (NaN, as in scipy.stats.pearsonr) for
+        # constant FCs, whose sum of squares is only a rounding error
+        eps = n_pairs * np.finfo(np.float64).eps
+        fc_corr[sim_fc_ss <= eps * sim_fc_sqsum] = np.nan
+        if emp_fc_ss <= eps * emp_fc_sqsum:
+            fc_corr[:] = np.nan
+        scores[:, col_idx["+fc_corr"]] = fc_corr
+        scores[:, col_idx["-fc_diff"]] = -np.abs(sim_fc_sum - emp_fc_sum) / n_pairs
+        scores[:, col_idx["-fc_normec"]] = -utils.fc_norm_euclidean(
+            self.sim_fc_trils, emp_fc_tril
+        )
+        # sorted sim FCDs are reused in the next calls if they were cached
+        sim_fcd_trils_sorted = getattr(self, "_sim_fcd_trils_sorted", None)
+        if (sim_fcd_trils_sorted is None) and cache_sorted:
+            sim_fcd_trils_sorted = np.sort(self.sim_fcd_trils, axis=1)
+            self._sim_fcd_trils_sorted = sim_fcd_trils_sorted
+        if sim_fcd_trils_sorted is None:
+            # rows are sorted in chunks without keeping a sorted copy
+            scores[:, col_idx["-fcd_ks"]] = -utils.ks_2samp_statistic(
+                self.sim_fcd_trils, emp_fcd_tril
             )
-            scores.loc[idx, "-fcd_ks"] = -scipy.stats.ks_2samp(
-                self.sim_fcd_trils[idx], emp_fcd_tril
-            ).statistic
-            scores.loc[idx, "-fc_normec"] = -utils.fc_norm_euclidean(
-                self.sim_fc_trils[idx], emp_fc_tril
+        else:
+            scores[:, col_idx["-fcd_ks"]] = -utils.ks_2samp_statistic(
+                sim_fcd_trils_sorted, np.sort(emp_fcd_tril), presorted=True
             )
-            # combined the selected terms into gof (that should be maximized)
-            scores.loc[idx, "+gof"] = 0
-            for term in self.gof_terms:
-                scores.loc[idx, "+gof"] += scores.loc[idx, term]
+        # combined the selected terms into gof (that should be maximized)
+        scores[:, col_idx["+gof"]] = scores[
+            :, [col_idx[term] for term in self.gof_terms]
+        ].sum(axis=1)
         # calculate FIC penalty
         if self.do_fic & self.fic_penalty:
-            for idx in range(self.N):
-                diff_r_E = np.abs(self.ext_out["r_E"][idx, :] - 3)
-                if (diff_r_E > 1).sum() > 0:
-                    diff_r_E[diff_r_E <= 1] = np.NaN
-                    scores.loc[idx, "-fic_penalty"] = (
-                        -np.nansum(1 - np.exp(-0.05 * (diff_r_E - 1)))
-                        * fic_penalty_scale / self.nodes
-                    )
-                else:
-                    scores.loc[idx, "-fic_penalty"] = 0
-        return scores
+            # only nodes with a deviation of > 1 Hz from the
+            # target are penalized
+            diff_r_E = np.abs(self.ext_out["r_E"] - 3)
+            node_penalties = np.where(
+                diff_r_E > 1, 1 - np.exp(-0.05 * (diff_r_E - 1)), 0.0
+            )
+            scores[:, col_idx["-fic_penalty"]] = (
+                -node_penalties.sum(axis=1) * fic_penalty_scale / self.nodes
+            )
+        return pd.DataFrame(scores, columns=columns)
+
+    def _get_save_data(self):
+        """
+        Gets the simulation outputs and parameters that are saved
 
-    def save(self, save_as="npz"):
+        Returns
+        -------
+        out_data: (dict of np.ndarray)
+            references to (not copies of) the arrays
         """
-        Save current simulation outputs to disk
+        out_data = {
+            "sim_bold": self.sim_bold,
+            "sim_fc_trils": self.sim_fc_trils,
+            "sim_fcd_trils": self.sim_fcd_trils,
+            # parameters which are not set are skipped
+            # as they would be pickled as object arrays
+            **{k: v for k, v in self.param_lists.items() if v is not None},
+        }
+        if self.extended_output:
+            out_data.update(self.ext_out)
+        return out_data
+
+    def save(self, save_as="npz", compression="auto"):
+        """
+        Save current simulation outputs to disk. Note that sim_bold
+        is stored (and saved) as float32, and the other outputs as float64
 
         Parameters
         ---------
@@ -365,19 +680,31 @@ class SimGroup:
             - npz: all the output of all sims will be written to a npz file
             - txt: outputs of simulations will be written to separate files,
                 recommended when N = 1 (e.g. rerunning the best simulation)
+        compression: (str)
+            compression of the npz file
+            - 'auto': compressed unless the outputs are larger than
+                MAX_COMPRESSED_SAVE_SIZE (1 GB), where the (single-threaded)
+                compression becomes much slower than writing the raw data
+            - 'deflate': always compressed
+            - 'none': never compressed
         """
+        if compression not in ["auto", "deflate", "none"]:
+            raise ValueError(f"Unknown compression: {compression}")
         sims_dir = self.out_dir
         os.makedirs(sims_dir, exist_ok=True)
         if save_as == "npz":
-            out_data = dict(
-                sim_bold=self.sim_bold,
-                sim_fc_trils=self.sim_fc_trils,
-                sim_fcd_trils=self.sim_fcd_trils,
-            )
-            out_data.update(self.param_lists)
-            if self.extended_output:
-                out_data.update(self.ext_out)
+            out_data = self._get_save_data()
+            if compression == "auto":
+                out_size = sum(np.asarray(v).nbytes for v in out_data.values())
+                if out_size > MAX_COMPRESSED_SAVE_SIZE:
+                    compression = "none"
+                else:
+                    compression = "deflate"
+            if compression == "none":
+                savez = np.savez
+            else:
+                savez = np.savez_compressed
             # TODO: use more informative filenames
-            np.savez_compressed(os.path.join(sims_dir, f"it{self.it}.npz"), **out_data)
+            savez(os.path.join(sims_dir, f"it{self.it}.npz"), **out_data)
         elif save_as == "txt":
             raise NotImplementedError
@@ -1,10 +1,15 @@
+import functools
 import numpy as np
-import scipy
 import GPUtil
 
+@functools.lru_cache(maxsize=1)
 def avail_gpus():
     """
     Gets the number of available GPUs
+
+    The result is cached as GPUtil queries nvidia-smi
+    on every call. Use `avail_gpus.cache_clear()` to
+    query it again
     """
     return len(GPUtil.getAvailable())
 
@@ -14,11 +19,103 @@ def fc_norm_euclidean(x, y):
     divided by their maximum possible distance, equal
     to the distance of np.ones(n_pairs) and -np.ones(n_pairs)
     or 2 * np.sqrt(n_pairs)
+
+    Parameters
+    ----------
+    x: (np.ndarray) (n_pairs,) or (N, n_pairs)
+        FC array(s)
+    y: (np.ndarray) (n_pairs,)
+        FC array
+
+    Returns
+    -------
+    dist: (float) or (np.ndarray) (N,)
     """
-    euclidean = scipy.spatial.distance.euclidean(x, y)
-    max_euclidean = 2 * np.sqrt(x.size)
+    euclidean = np.linalg.norm(x - y, axis=-1)
+    max_euclidean = 2 * np.sqrt(y.size)
     return euclidean / max_euclidean
 
+def ks_2samp_statistic(x, y, presorted=False, max_chunk_bytes=64 * 1024**2):
+    """
+    Calculates two-sample Kolmogorov-Smirnov statistic
+    of each row of x and y, equivalent to
+    scipy.stats.ks_2samp(x[i], y).statistic but vectorized
+    across rows. As in scipy, the statistic is NaN for rows
+    of x which include NaN, and for all rows if y includes NaN
+
+    Parameters
+    ----------
+    x: (np.ndarray) (N, n_x)
+    y: (np.ndarray) (n_y,)
+    presorted: (bool)
+        whether rows of x and y are already sorted
+    max_chunk_bytes: (int)
+        approximate maximum size of the temporary arrays.
+        Rows of x are processed in chunks within this limit
+
+    Returns
+    -------
+    stat: (np.ndarray) (N,)
+    """
+    if not presorted:
+        y = np.sort(y)
+    N, n_x = x.shape
+    # each row needs about 5 temporary arrays of size n_x or n_y + 1
+    chunk_size = max(1, max_chunk_bytes // (5 * 8 * (n_x + y.size + 1)))
+    stat = np.empty(N)
+    if np.isnan(y).any():
+        stat[:] = np.nan
+        return stat
+    for start in range(0, N, chunk_size):
+        x_chunk = x[start : start + chunk_size]
+        if not presorted:
+            x_chunk = np.sort(x_chunk, axis=1)
+        stat_chunk = _ks_2samp_statistic_sorted(x_chunk, y)
+        # NaNs are sorted to the end and treated as large values
+        # by searchsorted, therefore they are masked here
+        stat_chunk[np.isnan(x_chunk).any(axis=1)] = np.nan
+        stat[start : start + chunk_size] = stat_chunk
+    return stat
+
+
+def _ks_2samp_statistic_sorted(x, y):
+    """
+    Calculates two-sample Kolmogorov-Smirnov statistic
+    of each row of sorted x and sorted y. See ks_2samp_statistic
+
+    Parameters
+    ----------
+    x: (np.ndarray) (N, n_x)
+    y: (np.ndarray) (n_y,)
+
+    Returns
+    -------
+    stat: (np.ndarray) (N,)
+    """
+    N, n_x = x.shape
+    n_y = y.size
+    # the empirical CDFs are step functions and their maximum
+    # difference occurs at one of the data points, where
+    # in the case of ties only the last one should be used
+    # 1. difference at x data points
+    cdf_x = np.arange(1, n_x + 1) / n_x
+    cdf_y = np.searchsorted(y, x, side="right") / n_y
+    is_last = np.ones(x.shape, dtype=bool)
+    is_last[:, :-1] = x[:, 1:] != x[:, :-1]
+    stat_x = np.where(is_last, np.abs(cdf_x - cdf_y), 0).max(axis=1)
+    # 2. difference at y data points
+    # number of x[i] values <= y[k] is the number of x[i] values
+    # with <= k y values smaller than them, which is calculated
+    # by counting (per row) the ranks of x values within y
+    ranks = np.searchsorted(y, x, side="left")
+    ranks += np.arange(N)[:, np.newaxis] * (n_y + 1)
+    counts = np.bincount(ranks.ravel(), minlength=N * (n_y + 1))
+    cdf_x = counts.reshape(N, n_y + 1).cumsum(axis=1)[:, :n_y] / n_x
+    cdf_y = np.arange(1, n_y + 1) / n_y
+    is_last = np.append(y[1:] != y[:-1], True)
+    stat_y = np.abs(cdf_x - cdf_y)[:, is_last].max(axis=1)
+    return np.maximum(stat_x, stat_y)
+
 def get_bw_params(src):
     """
     Get Balloon-Windkessel model parameters
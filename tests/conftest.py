@@ -0,0 +1,68 @@
+"""
+Shared fixtures, including a stub in place of the compiled
+extension for tests that do not need to run the simulations
+"""
+import pytest
+import numpy as np
+from cuBNM import _core
+
+
+class StubCore:
+    """
+    Records the calls made to the extension, and returns random
+    outputs of the expected shapes from run_simulations
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.conf = {"max_fic_trials": 10}
+
+    def init(self):
+        self.calls.append(("init",))
+        self.conf = {"max_fic_trials": 10}
+
+    def set_const(self, key, value):
+        self.calls.append(("set_const", key, value))
+
+    def set_conf(self, key, value):
+        self.calls.append(("set_conf", key, value))
+        self.conf[key] = value
+
+    def get_conf(self):
+        self.calls.append(("get_conf",))
+        return dict(self.conf)
+
+    def run_simulations(
+        self, sc, sc_dist, G, wEE, wEI, wIE, v, do_fic, extended_output,
+        do_delay, force_reinit, use_cpu, N_SIMS, nodes, time_steps, BOLD_TR,
+        window_size, window_step, rand_seed,
+    ):
+        self.calls.append(("run_simulations",))
+        rng = np.random.default_rng(rand_seed)
+        n_trs = time_steps // BOLD_TR
+        n_pairs = nodes * (nodes - 1) // 2
+        n_windows = (n_trs - window_size) // window_step + 1
+        n_window_pairs = n_windows * (n_windows - 1) // 2
+        out = [
+            rng.normal(size=(N_SIMS, n_trs * nodes)),
+            rng.uniform(-1, 1, (N_SIMS, n_pairs)),
+            rng.uniform(-1, 1, (N_SIMS, n_window_pairs)),
+        ]
+        if extended_output:
+            out += [rng.uniform(0, 8, (N_SIMS, nodes)) for _ in range(9)]
+        out.append(np.zeros(N_SIMS, dtype=bool))
+        return tuple(out)
+
+
+@pytest.fixture
+def stub_core(monkeypatch):
+    """
+    Replaces the extension used by the _core wrappers with a StubCore
+    """
+    stub = StubCore()
+    monkeypatch.setattr(_core, "_ext", stub)
+    monkeypatch.setattr(_core, "_initialized", True)
+    monkeypatch.setattr(_core, "_conf_cache", None)
+    monkeypatch.setattr(_core, "_last_consts", {})
+    monkeypatch.setattr(_core, "_last_confs", {})
+    return stub
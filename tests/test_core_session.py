@@ -0,0 +1,59 @@
+"""
+Tests for the session handling of the _core wrappers, using
+a stub in place of the compiled extension (see conftest.py)
+"""
+from cuBNM import _core
+
+
+def test_set_const_skip(stub_core):
+    """
+    Tests if setting a constant to its current value is skipped
+    """
+    _core.set_const("k1", 2.38)
+    _core.set_const("k1", 2.38)
+    _core.set_const("k1", 3.72)
+    assert stub_core.calls == [
+        ("set_const", "k1", 2.38),
+        ("set_const", "k1", 3.72),
+    ]
+
+
+def test_set_conf_skip_and_get_conf_cache(stub_core):
+    """
+    Tests if setting a config to its current value is skipped
+    and if the cached configs are invalidated when they change
+    """
+    assert _core.get_conf()["max_fic_trials"] == 10
+    # modifying the returned configs should not affect the cache
+    _core.get_conf()["max_fic_trials"] = 0
+    assert _core.get_conf()["max_fic_trials"] == 10
+    assert stub_core.calls == [("get_conf",)]
+    _core.set_conf("max_fic_trials", 5)
+    _core.set_conf("max_fic_trials", 5)
+    assert _core.get_conf()["max_fic_trials"] == 5
+    assert stub_core.calls == [
+        ("get_conf",),
+        ("set_conf", "max_fic_trials", 5),
+        ("get_conf",),
+    ]
+
+
+def test_init_reset(stub_core):
+    """
+    Tests if init resets the skipped values and cached configs
+    """
+    _core.set_const("k1", 2.38)
+    _core.set_conf("max_fic_trials", 5)
+    assert _core.get_conf()["max_fic_trials"] == 5
+    _core.init()
+    assert _core.get_conf()["max_fic_trials"] == 10
+    # the same values should be set again after init
+    _core.set_const("k1", 2.38)
+    _core.set_conf("max_fic_trials", 5)
+    assert stub_core.calls[-5:] == [
+        ("get_conf",),
+        ("init",),
+        ("get_conf",),
+        ("set_const", "k1", 2.38),
+        ("set_conf", "max_fic_trials", 5),
+    ]
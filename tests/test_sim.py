@@ -0,0 +1,308 @@
+"""
+Tests for SimGroup and loading the SC matrices in sim
+"""
+import pytest
+import numpy as np
+import pandas as pd
+import scipy.stats
+import scipy.spatial
+import warnings
+import shutil
+import os
+from cuBNM import sim
+
+
+@pytest.fixture
+def sc_path(tmp_path, monkeypatch):
+    """
+    Writes an SC text file to a temporary directory and
+    uses a temporary directory for the binary copies
+    """
+    monkeypatch.setenv("CUBNM_CACHE_DIR", str(tmp_path / "cache"))
+    sim._load_matrix_cached.cache_clear()
+    path = tmp_path / "sc.txt"
+    np.savetxt(path, np.arange(9, dtype=float).reshape(3, 3))
+    yield str(path)
+    sim._load_matrix_cached.cache_clear()
+
+
+def cache_files():
+    cache_dir = sim._get_matrix_cache_dir()
+    if not os.path.exists(cache_dir):
+        return []
+    return [os.path.join(cache_dir, f) for f in os.listdir(cache_dir)]
+
+
+def test_load_matrix_writes_copy(sc_path):
+    """
+    Tests if the first load writes a binary copy which
+    is used by the next loads
+    """
+    mat = sim._load_matrix(sc_path)
+    assert np.array_equal(mat, np.loadtxt(sc_path))
+    assert not mat.flags.writeable
+    assert [os.path.splitext(f)[1] for f in cache_files()] == [".npz"]
+    sim._load_matrix_cached.cache_clear()
+    with np.load(cache_files()[0]) as copy:
+        assert np.array_equal(copy["mat"], mat)
+    assert np.array_equal(sim._load_matrix(sc_path), mat)
+
+
+@pytest.mark.parametrize("older", [False, True])
+def test_load_matrix_modified(sc_path, tmp_path, older):
+    """
+    Tests if a modified text file is reparsed, including when
+    it is replaced by a file with an older mtime (e.g. via cp -p)
+    """
+    sim._load_matrix(sc_path)
+    new_path = tmp_path / "new_sc.txt"
+    np.savetxt(new_path, np.ones((3, 3)))
+    if older:
+        os.utime(new_path, (0, 0))
+        shutil.copy2(new_path, sc_path)
+    else:
+        shutil.copyfile(new_path, sc_path)
+    assert np.array_equal(sim._load_matrix(sc_path), np.ones((3, 3)))
+    # the copy should also be updated
+    sim._load_matrix_cached.cache_clear()
+    assert np.array_equal(sim._load_matrix(sc_path), np.ones((3, 3)))
+
+
+@pytest.mark.parametrize("size", [0, 10, -10])
+def test_load_matrix_corrupt_copy(sc_path, size):
+    """
+    Tests if corrupt or truncated copies are ignored
+    and replaced
+    """
+    expected = sim._load_matrix(sc_path).copy()
+    copy_path = cache_files()[0]
+    with open(copy_path, "r+b") as f:
+        f.truncate(size if size >= 0 else os.path.getsize(copy_path) + size)
+    sim._load_matrix_cached.cache_clear()
+    assert np.array_equal(sim._load_matrix(sc_path), expected)
+    with np.load(copy_path) as copy:
+        assert np.array_equal(copy["mat"], expected)
+
+
+def test_load_matrix_read_only(sc_path):
+    """
+    Tests if the matrix is loaded when the binary copy
+    cannot be written to a read-only directory
+    """
+    cache_dir = sim._get_matrix_cache_dir()
+    os.makedirs(cache_dir)
+    os.chmod(cache_dir, 0o555)
+    try:
+        mat = sim._load_matrix(sc_path)
+        assert np.array_equal(mat, np.loadtxt(sc_path))
+        if os.geteuid() != 0:
+            # root can write to read-only directories
+            assert cache_files() == []
+    finally:
+        os.chmod(cache_dir, 0o755)
+
+
+def test_load_matrix_no_cache_dir(sc_path, monkeypatch):
+    """
+    Tests if the matrix is loaded when the directory of
+    binary copies cannot be created
+    """
+    monkeypatch.setenv("CUBNM_CACHE_DIR", os.path.join(sc_path, "cache"))
+    mat = sim._load_matrix(sc_path)
+    assert np.array_equal(mat, np.loadtxt(sc_path))
+
+
+@pytest.mark.parametrize(
+    "env, expected",
+    [
+        ({"CUBNM_CACHE_DIR": "/cubnm", "XDG_CACHE_HOME": "/xdg"}, "/cubnm/matrices"),
+        ({"XDG_CACHE_HOME": "/xdg", "HOME": "/home"}, "/xdg/cuBNM/matrices"),
+        ({"HOME": "/home"}, "/home/.cache/cuBNM/matrices"),
+        ({"CUBNM_CACHE_DIR": "", "HOME": "/home"}, None),
+    ],
+)
+def test_get_matrix_cache_dir(monkeypatch, env, expected):
+    """
+    Tests how the cache directory is determined
+    from the environment variables
+    """
+    for key in ["CUBNM_CACHE_DIR", "XDG_CACHE_HOME", "HOME"]:
+        monkeypatch.delenv(key, raising=False)
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    assert sim._get_matrix_cache_dir() == expected
+
+
+def test_load_matrix_disabled(sc_path, tmp_path, monkeypatch):
+    """
+    Tests if no binary copies are written when they are disabled
+    """
+    monkeypatch.setenv("CUBNM_CACHE_DIR", "")
+    mat = sim._load_matrix(sc_path)
+    assert np.array_equal(mat, np.loadtxt(sc_path))
+    assert not mat.flags.writeable
+    assert sorted(os.listdir(tmp_path)) == ["sc.txt"]
+
+
+def test_load_matrix_prune(sc_path, tmp_path, monkeypatch):
+    """
+    Tests if the least recently used binary copies beyond
+    MAX_CACHED_MATRICES are removed
+    """
+    monkeypatch.setattr(sim, "MAX_CACHED_MATRICES", 2)
+    sim._load_matrix(sc_path)
+    first_copy = cache_files()[0]
+    os.utime(first_copy, (0, 0))
+    for i in range(2):
+        path = tmp_path / f"sc{i}.txt"
+        shutil.copyfile(sc_path, path)
+        sim._load_matrix(path)
+    assert len(cache_files()) == 2
+    assert first_copy not in cache_files()
+
+
+@pytest.fixture
+def sim_group(tmp_path, monkeypatch, stub_core, request):
+    """
+    Creates a SimGroup of 10 nodes using the stub extension.
+    do_fic is set via indirect parametrization (default: True)
+    """
+    monkeypatch.setenv("CUBNM_CACHE_DIR", str(tmp_path / "cache"))
+    sc_path = tmp_path / "sc.txt"
+    np.savetxt(sc_path, np.random.default_rng(0).uniform(0, 1, (10, 10)))
+    sg = sim.SimGroup(
+        duration=60,
+        TR=1,
+        sc_path=str(sc_path),
+        out_dir=str(tmp_path / "out"),
+        do_fic=getattr(request, "param", True),
+    )
+    sg.N = 4
+    sg.param_lists["G"] = np.full(sg.N, 0.5)
+    sg.param_lists["wEE"] = np.full((sg.N, sg.nodes), 0.21)
+    sg.param_lists["wEI"] = np.full((sg.N, sg.nodes), 0.15)
+    if not sg.do_fic:
+        sg.param_lists["wIE"] = np.full((sg.N, sg.nodes), 1.0)
+    return sg
+
+
+def reference_score(sg, emp_fc_tril, emp_fcd_tril, fic_penalty_scale=2):
+    """
+    Per-simulation calculation of the scores using scipy
+    """
+    columns = ["+fc_corr", "-fc_diff", "-fcd_ks", "-fc_normec", "+gof"]
+    if sg.do_fic:
+        columns.append("-fic_penalty")
+    scores = pd.DataFrame(np.nan, index=range(sg.N), columns=columns)
+    for idx in range(sg.N):
+        sim_fc_tril = sg.sim_fc_trils[idx]
+        scores.loc[idx, "+fc_corr"] = scipy.stats.pearsonr(sim_fc_tril, emp_fc_tril).statistic
+        scores.loc[idx, "-fc_diff"] = -np.abs(sim_fc_tril.mean() - emp_fc_tril.mean())
+        scores.loc[idx, "-fcd_ks"] = -scipy.stats.ks_2samp(sg.sim_fcd_trils[idx], emp_fcd_tril).statistic
+        scores.loc[idx, "-fc_normec"] = -scipy.spatial.distance.euclidean(
+            sim_fc_tril, emp_fc_tril
+        ) / (2 * np.sqrt(emp_fc_tril.size))
+        scores.loc[idx, "+gof"] = scores.loc[idx, sg.gof_terms].sum(skipna=False)
+        if sg.do_fic & sg.fic_penalty:
+            diff_r_E = np.abs(sg.ext_out["r_E"][idx, :] - 3)
+            if (diff_r_E > 1).sum() > 0:
+                diff_r_E[diff_r_E <= 1] = np.nan
+                scores.loc[idx, "-fic_penalty"] = (
+                    -np.nansum(1 - np.exp(-0.05 * (diff_r_E - 1)))
+                    * fic_penalty_scale
+                    / sg.nodes
+                )
+            else:
+                scores.loc[idx, "-fic_penalty"] = 0
+    return scores
+
+
+@pytest.mark.parametrize("sim_group", [True, False], indirect=True)
+def test_score(sim_group):
+    """
+    Tests if the vectorized scores match the per-simulation
+    calculations, including a constant sim FC (for which
+    +fc_corr is NaN) and a sim FCD with a NaN (for which
+    -fcd_ks is NaN)
+    """
+    sim_group.run()
+    sim_group.sim_fc_trils[1] = 0.3
+    sim_group.sim_fcd_trils[2, 0] = np.nan
+    if sim_group.do_fic:
+        # a simulation without any penalized nodes
+        sim_group.ext_out["r_E"][3] = 3.5
+    rng = np.random.default_rng(1)
+    emp_fc_tril = rng.uniform(-1, 1, sim_group.sim_fc_trils.shape[1])
+    emp_fcd_tril = rng.uniform(-1, 1, 200)
+    with warnings.catch_warnings():
+        # scipy warns about the constant input
+        warnings.simplefilter("ignore")
+        expected = reference_score(sim_group, emp_fc_tril, emp_fcd_tril)
+    scores = sim_group.score(emp_fc_tril, emp_fcd_tril)
+    assert list(scores.columns) == list(expected.columns)
+    assert np.isclose(scores.values, expected.values, atol=1e-12, equal_nan=True).all()
+    assert np.isnan(scores.loc[1, "+fc_corr"])
+    assert np.isnan(scores.loc[2, "-fcd_ks"])
+
+
+def test_score_cache_sorted(sim_group):
+    """
+    Tests if the sorted sim FCDs are only cached when requested
+    and are not reused after sim_fcd_trils is reassigned
+    """
+    sim_group.run()
+    rng = np.random.default_rng(1)
+    emp_fc_tril = rng.uniform(-1, 1, sim_group.sim_fc_trils.shape[1])
+    emp_fcd_tril = rng.uniform(-1, 1, 200)
+    sim_group.score(emp_fc_tril, emp_fcd_tril)
+    assert sim_group._sim_fcd_trils_sorted is None
+    scores = sim_group.score(emp_fc_tril, emp_fcd_tril, cache_sorted=True)
+    assert sim_group._sim_fcd_trils_sorted is not None
+    # e.g. rescoring loaded outputs
+    sim_group.sim_fcd_trils = rng.uniform(-1, 1, sim_group.sim_fcd_trils.shape)
+    assert sim_group._sim_fcd_trils_sorted is None
+    new_scores = sim_group.score(emp_fc_tril, emp_fcd_tril)
+    expected = reference_score(sim_group, emp_fc_tril, emp_fcd_tril)
+    assert np.isclose(new_scores["-fcd_ks"], expected["-fcd_ks"], atol=1e-12).all()
+    assert not np.isclose(new_scores["-fcd_ks"], scores["-fcd_ks"]).all()
+    sim_group.clear()
+    assert not hasattr(sim_group, "sim_fcd_trils")
+    assert not hasattr(sim_group, "_sim_fcd_trils_sorted")
+
+
+def test_process_out(sim_group):
+    """
+    Tests the dtypes and shapes of the simulation outputs
+    """
+    sim_group.run()
+    n_trs = sim_group.duration_msec // sim_group.TR_msec
+    assert sim_group.sim_bold.dtype == np.float32
+    assert sim_group.sim_bold.shape == (sim_group.N, n_trs, sim_group.nodes)
+    assert sim_group.sim_fc_trils.shape == (sim_group.N, sim_group.nodes * (sim_group.nodes - 1) // 2)
+    assert sim_group.sim_fcd_trils.dtype == np.float64
+    assert sim_group.ext_out["r_E"].shape == (sim_group.N, sim_group.nodes)
+    sim_group.save()
+    with np.load(os.path.join(sim_group.out_dir, f"it{sim_group.it}.npz")) as saved:
+        assert saved["sim_bold"].dtype == np.float32
+        assert saved["sim_bold"].shape == sim_group.sim_bold.shape
+
+
+@pytest.mark.parametrize("sim_group", [True, False], indirect=True)
+def test_check_params(sim_group, stub_core):
+    """
+    Tests if run raises an error for parameters which are
+    not set or have the wrong size, without running the simulations
+    """
+    sim_group._check_params()
+    for param, wrong_size in [("G", sim_group.N + 1), ("wEE", sim_group.N)]:
+        values = sim_group.param_lists[param]
+        sim_group.param_lists[param] = None
+        with pytest.raises(ValueError, match=f"{param} is not set"):
+            sim_group.run()
+        sim_group.param_lists[param] = np.zeros(wrong_size)
+        with pytest.raises(ValueError, match=f"{param} has {wrong_size} values"):
+            sim_group.run()
+        sim_group.param_lists[param] = values
+    assert ("run_simulations",) not in stub_core.calls
+    sim_group.run()
+    assert ("run_simulations",) in stub_core.calls
@@ -0,0 +1,54 @@
+"""
+Tests for the vectorized GOF helpers in utils
+"""
+import pytest
+import numpy as np
+import scipy.stats
+import scipy.spatial
+from cuBNM import utils
+
+
+@pytest.mark.parametrize("decimals", [None, 1])
+@pytest.mark.parametrize("max_chunk_bytes", [64 * 1024**2, 50000])
+@pytest.mark.parametrize("nan_in", [None, "x", "y"])
+def test_ks_2samp_statistic(decimals, max_chunk_bytes, nan_in):
+    """
+    Tests if the vectorized KS statistic matches scipy.stats.ks_2samp
+    for each row, with or without tied values (when `decimals` is set)
+    and when rows are processed in one or several chunks. With NaNs
+    in x (`nan_in="x"`) or y (`nan_in="y"`) the affected statistics
+    should be NaN as in scipy
+    """
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-1, 1, (10, 300))
+    y = rng.uniform(-1, 1, 250)
+    if decimals is not None:
+        x = np.round(x, decimals)
+        y = np.round(y, decimals)
+    if nan_in == "x":
+        x[1, 5] = np.nan
+        x[3, :] = np.nan
+    elif nan_in == "y":
+        y[5] = np.nan
+    stat = utils.ks_2samp_statistic(x, y, max_chunk_bytes=max_chunk_bytes)
+    expected = [scipy.stats.ks_2samp(x[i], y).statistic for i in range(x.shape[0])]
+    assert np.isclose(stat, expected, atol=1e-12, equal_nan=True).all()
+    if nan_in is not None:
+        assert np.isnan(stat).sum() == (2 if nan_in == "x" else x.shape[0])
+
+
+def test_fc_norm_euclidean():
+    """
+    Tests if the normalized Euclidean distance of FC arrays
+    is the same for 1D and 2D inputs
+    """
+    rng = np.random.default_rng(0)
+    x = rng.uniform(-1, 1, (10, 190))
+    y = rng.uniform(-1, 1, 190)
+    dist = utils.fc_norm_euclidean(x, y)
+    expected = [
+        scipy.spatial.distance.euclidean(x[i], y) / (2 * np.sqrt(y.size))
+        for i in range(x.shape[0])
+    ]
+    assert np.isclose(dist, expected, atol=1e-12).all()
+    assert np.isclose(utils.fc_norm_euclidean(x[0], y), expected[0], atol=1e-12)